@@ -5,53 +5,87 @@ logging.basicConfig(stream=sys.stdout,
     level=logging.DEBUG if os.environ.get('DEBUG') else logging.INFO)
 
 os.environ['SDL_AUDIODRIVER'] = 'alsa'
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
 
 import time
-import json
 
 import asyncio
-from asyncio_mqtt import Client
+import paho.mqtt.client as mqtt
 import pygame
+import orjson
 
 import secrets
 
-COOLDOWN = time.time()
+DEBOUNCE = 5.0
+
+LAST_RING = {}
+RINGING = set()
+
+TOPIC = 'rtl_433/#'
+QUEUE_SIZE = 64
 
 CHIME = 'chime.ogg'
 
 DOORBELLS = {
-    '647166': {
+    647166: {
         'name': 'Front Door',
         'sound': 'frontdoor.ogg',
     },
-    '549660': {
+    549660: {
         'name': 'Back Door',
         'sound': 'backdoor.ogg',
     },
-    '56504': {
+    56504: {
         'name': 'Test Door',
         'sound': 'testing.ogg',
     },
 }
 
+DOORBELL_IDS = frozenset(DOORBELLS)
+
+SOUNDS = {}
+CHANNEL = None
+
+def select_buffer():
+    # 4096 samples is known not to underrun on the Pi; smaller buffers only
+    # cut latency, so only use one where it has been tested with AUDIO_BUFFER
+    return int(os.environ.get('AUDIO_BUFFER', 4096))
+
+def load_sounds():
+    global CHANNEL
+    for filename in (CHIME, *[d['sound'] for d in DOORBELLS.values()]):
+        SOUNDS[filename] = pygame.mixer.Sound(filename)
+
+    CHANNEL = pygame.mixer.Channel(0)
+
 async def play_sound(filename):
-    pygame.mixer.music.load(filename)
-    pygame.mixer.music.play()
+    sound = SOUNDS[filename]
+    CHANNEL.play(sound)
 
     logging.info('Playing sound %s', filename)
 
-    while pygame.mixer.music.get_busy():
-        #pygame.time.Clock().tick(10)
-        await asyncio.sleep(0.1)
+    # sleep for the clip's length, then give the mixer a bounded tail to
+    # drain its buffer so a stuck channel can't hang the bell
+    await asyncio.sleep(sound.get_length())
+    for _ in range(10):
+        if not CHANNEL.get_busy():
+            break
+        await asyncio.sleep(0.01)
 
 
-async def ring_bell(sound):
-    global COOLDOWN
-    if time.time() - COOLDOWN < 5.0:
-        logging.info('Cooldown skipping.')
-        return
-    COOLDOWN = time.time()
+def debounce(id_):
+    # rtl_433 repeats each press several times, so only ring once per
+    # doorbell every DEBOUNCE seconds
+    now = time.monotonic()
+    last_ring = LAST_RING.get(id_)
 
+    if last_ring is not None and now - last_ring < DEBOUNCE:
+        return False
+
+    LAST_RING[id_] = now
+    return True
+
+async def ring_bell(sound):
     await asyncio.sleep(0.1)
 
     if sound != 'testing.ogg':
@@ -66,42 +100,136 @@ async def ring_bell(sound):
 
     logging.info('Done ringing.')
 
-async def process_mqtt(message):
-    text = message.payload.decode()
+def process_mqtt(message, rings):
     topic = message.topic
-    logging.info('MQTT topic: %s, message: %s', topic, text)
 
+    # the broker filters on rtl_433/# already, but bail before decoding anything
     if not topic.startswith('rtl_433'):
-        logging.info('Invalid topic, returning')
+        logging.info('Invalid topic %s, returning', topic)
+        return
+
+    if b'"id"' not in message.payload:
+        logging.debug('No id in message on %s, returning', topic)
         return
 
+    if logging.root.isEnabledFor(logging.DEBUG):
+        logging.debug('MQTT topic: %s, message: %s', topic, message.payload.decode(errors='replace'))
+
     try:
-        data = json.loads(text)
-    except json.JSONDecodeError:
-        logging.info('Invalid json, returning')
+        data = orjson.loads(message.payload)
+    except orjson.JSONDecodeError:
+        logging.info('Invalid json on %s, returning', topic)
+        return
+
+    if not isinstance(data, dict):
+        logging.info('Invalid message on %s, returning', topic)
         return
 
-    id_ = str(data.get('id', ''))
+    # rtl_433 reports ids as ints
+    id_ = data.get('id')
 
-    if id_ not in DOORBELLS:
-        logging.info('Invalid id, returning')
+    if not isinstance(id_, int) or id_ not in DOORBELL_IDS:
+        logging.info('Invalid id %r, returning', id_)
         return
 
     doorbell = DOORBELLS[id_]
 
+    sound = doorbell['sound']
+
+    # a ring for this door is already queued or playing, don't pile up more
+    if sound in RINGING:
+        logging.info('Already ringing %s, skipping.', doorbell['name'])
+        return
+
+    if not debounce(id_):
+        logging.info('Debouncing %s, skipping.', doorbell['name'])
+        return
+
     logging.info('Ringing %s...', doorbell['name'])
 
-    await ring_bell(doorbell['sound'])
+    RINGING.add(sound)
+    rings.put_nowait(sound)
+
+
+# messages and rings get their own tasks so MQTT keeps draining while the
+# bell is playing, and the debounce sees presses when they actually arrive
+async def process_worker(queue, rings):
+    while True:
+        message = await queue.get()
+        try:
+            process_mqtt(message, rings)
+        except Exception:
+            logging.exception('Error processing MQTT message')
+
+async def ring_worker(rings):
+    while True:
+        sound = await rings.get()
+        try:
+            await ring_bell(sound)
+        except Exception:
+            logging.exception('Error ringing bell')
+        finally:
+            RINGING.discard(sound)
+
+
+def on_connect(client, queue, flags, rc):
+    if rc != 0:
+        logging.warning('MQTT connection refused: %s', mqtt.connack_string(rc))
+        return
+
+    logging.info('Connected to MQTT broker')
+    client.subscribe(TOPIC)
+
+def on_message(client, queue, message):
+    try:
+        queue.put_nowait(message)
+    except asyncio.QueueFull:
+        logging.warning('Message queue full, dropping message')
+
+# paho runs on the asyncio loop: read and write whenever its socket is ready
+def on_socket_open(client, queue, sock):
+    asyncio.get_event_loop().add_reader(sock, client.loop_read)
+
+def on_socket_close(client, queue, sock):
+    asyncio.get_event_loop().remove_reader(sock)
+
+def on_socket_register_write(client, queue, sock):
+    asyncio.get_event_loop().add_writer(sock, client.loop_write)
+
+def on_socket_unregister_write(client, queue, sock):
+    asyncio.get_event_loop().remove_writer(sock)
 
 
 async def fetch_mqtt():
+    queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+    rings = asyncio.Queue()
+    # held only so the loop's weak task references don't let them be collected
+    workers = [
+        asyncio.create_task(process_worker(queue, rings)),
+        asyncio.create_task(ring_worker(rings)),
+    ]
+
     await asyncio.sleep(3)
-    async with Client('localhost') as client:
-        async with client.filtered_messages('#') as messages:
-            await client.subscribe('#')
-            async for message in messages:
-                loop = asyncio.get_event_loop()
-                loop.create_task(process_mqtt(message))
+
+    client = mqtt.Client(userdata=queue)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.on_socket_open = on_socket_open
+    client.on_socket_close = on_socket_close
+    client.on_socket_register_write = on_socket_register_write
+    client.on_socket_unregister_write = on_socket_unregister_write
+    client.connect_async('localhost')
+
+    # keepalive pings and (re)connects still need a periodic nudge
+    while True:
+        if client.loop_misc() == mqtt.MQTT_ERR_NO_CONN:
+            logging.info('MQTT not connected, connecting...')
+            try:
+                client.reconnect()
+            except OSError as e:
+                logging.warning('MQTT connect failed: %s', e)
+
+        await asyncio.sleep(1)
 
 
 if __name__ == '__main__':
@@ -109,8 +237,12 @@ if __name__ == '__main__':
     logging.info('==========================')
     logging.info('Booting up...')
 
-    pygame.mixer.pre_init(buffer=4096)
-    pygame.mixer.init(buffer=4096)
+    buffer = select_buffer()
+    logging.info('Using mixer buffer size %s', buffer)
+
+    pygame.mixer.pre_init(frequency=44100, size=-16, channels=2, buffer=buffer)
+    pygame.mixer.init()
+    load_sounds()
 
     loop = asyncio.get_event_loop()
     loop.run_until_complete(fetch_mqtt())